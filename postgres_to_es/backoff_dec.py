@@ -1,23 +1,157 @@
 """Параметрический декоратор для осуществления
 экспоненциально растущей паузы между повторными
 вызовами декорируемой функции.
+
+Помимо паузы модуль реализует:
+ - классификацию ошибок на временные (повторяем) и постоянные (пробрасываем сразу);
+ - "полный джиттер" паузы, чтобы повторы разных вызовов не шли синхронно;
+ - бюджет повторов: ограничение числа попыток и общего времени (deadline);
+ - общий для бэкенда (postgres, elasticsearch) предохранитель (circuit breaker),
+   который при серии сбоев приостанавливает работу с бэкендом, а не долбит его запросами;
+ - хук on_retry для восстановления соединения перед очередной попыткой.
 """
 import time
+import random
 import logging
+import threading
+import configparser
 
 from functools import wraps
+from typing import Callable, Optional
+
+# значения по умолчанию, могут быть переопределены в секции [Backoff] файла settings.ini
+_config = configparser.ConfigParser()
+_config.read('settings.ini')
+
+START_SLEEP_TIME = _config.getfloat('Backoff', 'start_sleep_time', fallback=0.1)
+FACTOR = _config.getfloat('Backoff', 'factor', fallback=2)
+BORDER_SLEEP_TIME = _config.getfloat('Backoff', 'border_sleep_time', fallback=10)
+MAX_ATTEMPTS = _config.getint('Backoff', 'max_attempts', fallback=8)
+DEADLINE = _config.getfloat('Backoff', 'deadline', fallback=120)
+FAILURE_THRESHOLD = _config.getint('Backoff', 'failure_threshold', fallback=5)
+RECOVERY_TIMEOUT = _config.getfloat('Backoff', 'recovery_timeout', fallback=30)
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Классификатор по умолчанию: временными считаются сетевые ошибки и таймауты.
+    Классификаторы для конкретных бэкендов дополняют его своими исключениями.
+    """
+    return isinstance(exc, (ConnectionError, TimeoutError))
+
 
-def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10):
+class CircuitOpenError(ConnectionError):
+    """Предохранитель открыт, а бюджет времени не позволяет дождаться его восстановления."""
+
+
+class CircuitBreaker:
+    """Предохранитель, общий для всех вызовов одного бэкенда.
+
+    closed    - вызовы проходят, считаем подряд идущие сбои;
+    open      - после failure_threshold сбоев вызовы ждут recovery_timeout сек;
+    half-open - пропускается пробный вызов: успех закрывает предохранитель,
+                сбой снова его открывает.
     """
-    Функция для повторного выполнения функции через некоторое время, если возникла ошибка.
-    Использует наивный экспоненциальный рост времени повтора (factor) до граничного времени ожидания (border_sleep_time)
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str,
+                 failure_threshold: int = FAILURE_THRESHOLD,
+                 recovery_timeout: float = RECOVERY_TIMEOUT) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        """Сколько секунд осталось до пробного вызова (0, если предохранитель не открыт)."""
+        with self._lock:
+            if self.state != CircuitBreaker.OPEN:
+                return 0.0
+            return max(0.0, self.opened_at + self.recovery_timeout - time.monotonic())
+
+    def wait(self) -> None:
+        """Приостановить выполнение, пока предохранитель открыт."""
+        with self._lock:
+            if self.state != CircuitBreaker.OPEN:
+                return
+            remaining = self.opened_at + self.recovery_timeout - time.monotonic()
+        if remaining > 0:
+            logging.warning(f"Бэкенд {self.name} недоступен, пауза {remaining:.1f} сек")
+            time.sleep(remaining)
+        with self._lock:
+            if self.state == CircuitBreaker.OPEN:
+                self.state = CircuitBreaker.HALF_OPEN
+                logging.info(f"Предохранитель {self.name}: пробный вызов")
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != CircuitBreaker.CLOSED:
+                logging.info(f"Предохранитель {self.name} закрыт, бэкенд снова доступен")
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != CircuitBreaker.OPEN:
+                    logging.warning(f"Предохранитель {self.name} открыт после {self.failures} сбоев")
+                self.state = CircuitBreaker.OPEN
+                self.opened_at = time.monotonic()
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+# бэкенды, для которых в текущем потоке уже работает цикл повторов
+_active = threading.local()
+
+
+def get_breaker(backend: str) -> CircuitBreaker:
+    """Получить (создав при первом обращении) предохранитель бэкенда."""
+    with _breakers_lock:
+        if backend not in _breakers:
+            _breakers[backend] = CircuitBreaker(backend)
+        return _breakers[backend]
+
+
+def backoff(start_sleep_time: float = START_SLEEP_TIME,
+            factor: float = FACTOR,
+            border_sleep_time: float = BORDER_SLEEP_TIME,
+            max_attempts: int = MAX_ATTEMPTS,
+            deadline: float = DEADLINE,
+            backend: Optional[str] = None,
+            transient: Callable[[BaseException], bool] = is_transient,
+            on_retry: Optional[Callable] = None):
+    """
+    Функция для повторного выполнения функции через некоторое время, если возникла временная ошибка.
+    Использует экспоненциальный рост времени повтора (factor) до граничного времени ожидания (border_sleep_time)
+    с "полным джиттером": фактическая пауза выбирается случайно из [0, t].
 
     Формула:
-        t = start_sleep_time * 2^(n) if t < border_sleep_time
+        t = start_sleep_time * factor^(n) if t < border_sleep_time
         t = border_sleep_time if t >= border_sleep_time
+        пауза = random(0, t)
+
+    Постоянные ошибки (transient(e) is False) пробрасываются сразу, без повторов.
+    Если для бэкенда уже выполняется внешний цикл повторов (например, check_index
+    внутри insert_films), вложенный вызов не повторяется, а отдаёт ошибку наружу.
+
     :param start_sleep_time: начальное время повтора
     :param factor: во сколько раз нужно увеличить время ожидания
     :param border_sleep_time: граничное время ожидания
+    :param max_attempts: максимальное число попыток, 0 - без ограничения
+    :param deadline: предельное время повторов в секундах, 0 - без ограничения;
+                     проверяется перед каждой паузой (джиттер и ожидание предохранителя),
+                     длительность самого вызова функции не прерывается
+    :param backend: имя бэкенда, для которого используется общий предохранитель
+    :param transient: классификатор, возвращающий True для временных ошибок
+    :param on_retry: хук перед повторной попыткой (например, переподключение),
+                     вызывается с теми же аргументами, что и декорируемая функция
     :return: результат выполнения функции
     """
 
@@ -25,19 +159,57 @@ def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10):
         @wraps(func)
         def inner(*args, **kwargs):
             logging.debug(f"Выполнение функции {func.__name__}")
+            active = getattr(_active, 'backends', set())
+            if backend and backend in active:
+                return func(*args, **kwargs)
+
+            breaker = None
+            if backend:
+                breaker = get_breaker(backend)
+                _active.backends = active | {backend}
+            started = time.monotonic()
             n = 0
-            while True:
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    logging.warning(f"Ошибка выполнения функции {func.__name__}")
-                    n += 1
-                    t = start_sleep_time * factor**n
-                    if t >= border_sleep_time:
-                        t = border_sleep_time
-                    logging.debug(f"Пауза до следующего выполнения функции: {t} сек")
-                    time.sleep(t)
+            try:
+                while True:
+                    if breaker:
+                        pause = breaker.remaining()
+                        if deadline and time.monotonic() - started + pause > deadline:
+                            logging.error(f"Бэкенд {backend} недоступен дольше, чем позволяет "
+                                          f"время ({deadline} сек) повторов функции {func.__name__}")
+                            raise CircuitOpenError(f"Предохранитель {backend} открыт")
+                        breaker.wait()
+                    try:
+                        if n and on_retry:
+                            on_retry(*args, **kwargs)
+                        result = func(*args, **kwargs)
+                    except Exception as e:
+                        if not transient(e):
+                            logging.error(f"Постоянная ошибка в функции {func.__name__}, повтор не выполняется")
+                            # бэкенд ответил, значит он доступен: закрываем предохранитель,
+                            # иначе пробный вызов в состоянии half-open остался бы незавершённым
+                            if breaker:
+                                breaker.record_success()
+                            raise
+                        logging.warning(f"Ошибка выполнения функции {func.__name__}: {e.__class__.__name__}: {e}")
+                        if breaker:
+                            breaker.record_failure()
+                        n += 1
+                        if max_attempts and n >= max_attempts:
+                            logging.error(f"Исчерпано число попыток ({max_attempts}) для функции {func.__name__}")
+                            raise
+                        t = min(start_sleep_time * factor**n, border_sleep_time)
+                        t = random.uniform(0, t)
+                        if deadline and time.monotonic() - started + t > deadline:
+                            logging.error(f"Истекло время ({deadline} сек) повторов функции {func.__name__}")
+                            raise
+                        logging.debug(f"Пауза до следующего выполнения функции: {t:.2f} сек")
+                        time.sleep(t)
+                    else:
+                        if breaker:
+                            breaker.record_success()
+                        return result
+            finally:
+                _active.backends = active
         return inner
 
     return func_wrapper
-
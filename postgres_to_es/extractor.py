@@ -11,9 +11,35 @@ import configparser
 
 from models import FilmworkModel, Schema
 from transform import Transform
+from load import is_es_transient
 from psycopg2.extensions import connection as _connection
 from datetime import datetime
-from backoff_dec import backoff
+from typing import Callable, Optional
+from backoff_dec import backoff, is_transient
+
+# ошибки подключения, которые не исправятся повтором: неверные учётные данные,
+# запрет в pg_hba.conf, несуществующие база или пользователь
+PG_PERMANENT_CODES = ('28000', '28P01', '3D000')
+PG_PERMANENT_MESSAGES = ('password authentication failed',
+                         'no pg_hba.conf entry',
+                         'does not exist')
+
+
+def is_pg_transient(exc: BaseException) -> bool:
+    """Временные ошибки Postgres: потеря соединения, недоступность сервера,
+    конфликты сериализации и взаимоблокировки. Ошибки в SQL-запросе
+    (ProgrammingError, DataError и т.п.) и ошибки авторизации или
+    несуществующей базы при подключении считаются постоянными.
+    """
+    if isinstance(exc, psycopg2.OperationalError):
+        # при ошибке подключения psycopg2 обычно не заполняет pgcode, поэтому проверяем и текст
+        if exc.pgcode in PG_PERMANENT_CODES or any(msg in str(exc) for msg in PG_PERMANENT_MESSAGES):
+            return False
+        return True
+    if isinstance(exc, (psycopg2.InterfaceError,
+                        pg_extensions.TransactionRollbackError)):
+        return True
+    return is_transient(exc)
 
 
 class LoggingCursor(pg_extensions.cursor):
@@ -37,8 +63,10 @@ class Extractor:
     cnt_part_load = 0
     cnt_successes = 0
 
-    def __init__(self, connection: _connection, dsl: dict):
+    def __init__(self, connection: _connection, dsl: dict,
+                 connect: Optional[Callable[[], _connection]] = None):
         self.conn = connection
+        self.connect = connect
         self.es_host = dsl['host']
         self.es_port = int(dsl['port'])
 
@@ -71,10 +99,43 @@ class Extractor:
                 """
         return query
 
-    @backoff()
-    def query_exec(self, cursor, query_to_exec):
+    def close(self):
+        self.conn.close()
+
+    def recover(self, *args, **kwargs):
+        """Хук перед повторным запросом: откатывает прерванную транзакцию
+        или, если соединение разорвано, устанавливает его заново.
+        """
+        if not self.conn.closed:
+            try:
+                self.conn.rollback()
+                return
+            except psycopg2.Error as e:
+                logging.warning('%s: %s' % (e.__class__.__name__, e))
+        if self.connect is None:
+            return
+        logging.info('Переподключение к PostgreSQL')
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+        self.conn = self.connect()
+
+    @backoff(backend='postgres', transient=is_pg_transient, on_retry=recover)
+    def query_exec(self, query_to_exec):
         logging.debug(query_to_exec)
-        cursor.execute(query_to_exec)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(query_to_exec)
+        except Exception:
+            cursor.close()
+            # откатываем прерванную транзакцию, иначе после постоянной ошибки
+            # или исчерпания повторов все следующие запросы упадут с InFailedSqlTransaction
+            try:
+                self.conn.rollback()
+            except psycopg2.Error as e:
+                logging.warning('%s: %s' % (e.__class__.__name__, e))
+            raise
         return cursor
 
     def get_key_value(self, key: str) -> str:
@@ -100,7 +161,16 @@ class Extractor:
         chunk = [itm[0] for itm in chunk]
         return date, chunk
 
-    def get_films(self, model: Schema, entities: list):
+    def get_films(self, model: Schema, entities: list) -> bool:
+        """Отправляет в ES фильмы, связанные с изменёнными сущностями,
+        и сдвигает состояние model.key до model.modified, только если
+        записаны все фильмы. Временные ошибки пробрасываются вызывающему,
+        чтобы состояние не сдвинулось за незаписанные фильмы. Пачки с постоянной
+        ошибкой (невалидные данные, отказ маппинга) повтор не исправит: их id
+        пишутся в лог, и состояние сдвигается дальше.
+
+        :return: True, если все фильмы записаны и состояние изменено
+        """
         query = \
             f"""
             SELECT DISTINCT fw.id
@@ -121,23 +191,33 @@ class Extractor:
                 LIMIT {self.chunk};
                 """
 
-        with self.conn.cursor() as cur_films:
-            # запрашиваем CHUNK фильмов, которое связано с изменениями
-            cur_films = self.query_exec(cur_films, query)
-            # готовим fetch_size кусок UUIN фильмов для пушинга в ES
-            while films := cur_films.fetchmany(self.fetch_size):
-                self.films_to_es = [record[0] for record in films]
-                logging.debug(f'Вызван для {model.table} --- Фильмы собраны для ES:')
-                try:
-                    # запуск обогатителя: добавит недостающую информацию и запишет в ES
-                    self.postgres_enricher()
-                    # Если запись прошла успешно то меняем статус
-                    if Extractor.cnt_part_load == Extractor.cnt_successes:
-                        # Изменяем сотояние (дату) для параметра от имени которого произошел вызов функции
-                        self.manager.set_state(model.key, model.modified)
-                        logging.info(f"Изменено сотояние для ключа {model.key} в значение {model.modified}")
-                except Exception as e:
-                    logging.exception('%s: %s' % (e.__class__.__name__, e))
+        # запрашиваем CHUNK фильмов, которое связано с изменениями.
+        # Считываем его целиком: обогатитель при сбое может переподключиться к PG,
+        # и курсор на старом соединении станет недоступен
+        with self.query_exec(query) as cur_films:
+            films = cur_films.fetchall()
+
+        # готовим fetch_size кусок UUIN фильмов для пушинга в ES
+        for start in range(0, len(films), self.fetch_size):
+            self.films_to_es = [record[0] for record in films[start:start + self.fetch_size]]
+            logging.debug(f'Вызван для {model.table} --- Фильмы собраны для ES:')
+            try:
+                # запуск обогатителя: добавит недостающую информацию и запишет в ES
+                self.postgres_enricher()
+            except Exception as e:
+                if is_pg_transient(e) or is_es_transient(e):
+                    raise
+                logging.error(f"Постоянная ошибка {e.__class__.__name__}: {e}. "
+                              f"Фильмы пропущены: {', '.join(str(el) for el in self.films_to_es)}")
+                continue
+            if Extractor.cnt_part_load != Extractor.cnt_successes:
+                logging.warning(f"Записаны не все фильмы, состояние ключа {model.key} не изменено")
+                return False
+
+        # Все фильмы записаны: изменяем сотояние (дату) для параметра от имени которого произошел вызов функции
+        self.manager.set_state(model.key, model.modified)
+        logging.info(f"Изменено сотояние для ключа {model.key} в значение {model.modified}")
+        return True
 
     def postgres_producer(self):
         # ЗАПУСАЕМ ПРОЦЕСС В БЕСКОНЕЧНОМ ЦИКЛЕ
@@ -158,19 +238,28 @@ class Extractor:
             objects.append(Schema('film_work', Extractor.FILM_MODIFIED_KEY, data))
 
             for cur_model in objects:
-                # Считывание данных из PG
-                with self.conn.cursor() as cur:
-                    # запрашиваем CHUNK которые изменились после даты _MODIFIED
-                    cur = self.query_exec(cur, self.get_query(cur_model))
-                    while records := cur.fetchmany(self.fetch_size):
+                try:
+                    # Считывание данных из PG: запрашиваем CHUNK которые изменились после даты _MODIFIED.
+                    # Считываем его целиком до вложенных запросов, которые могут переподключиться к PG
+                    with self.query_exec(self.get_query(cur_model)) as cur:
+                        records = cur.fetchall()
+
+                    for start in range(0, len(records), self.fetch_size):
                         # формируем (кусочек) UUIN персоналий
-                        changed_entities = [record for record in records]
+                        changed_entities = records[start:start + self.fetch_size]
                         # запомним дату пследнего из fetch_size для изменения статуса
                         cur_model.modified, changed_entities = self.get_date_from_chunk_and_cut(changed_entities)
 
-                        if changed_entities:
-                            # готовим CHUNK фильмов связанных с изменениями и отправляем в ES
-                            self.get_films(cur_model, changed_entities)
+                        # готовим CHUNK фильмов связанных с изменениями и отправляем в ES.
+                        # При неудаче дальше по модели не идём, чтобы не сдвинуть состояние
+                        # за незаписанные фильмы
+                        if not self.get_films(cur_model, changed_entities):
+                            break
+                except Exception as e:
+                    # бюджет повторов исчерпан или ошибка постоянная: состояние модели
+                    # не сдвигалось дальше последней успешной записи, поэтому
+                    # оставшиеся изменения будут выбраны повторно в следующей сессии
+                    logging.exception('%s: %s' % (e.__class__.__name__, e))
 
             Extractor.cnt_part_load = 0
             Extractor.cnt_successes = 0
@@ -194,6 +283,11 @@ class Extractor:
         по которому дополняет данные из остальных таблиц
         и передает подготовленные данные в Тransform.
         """
+        # сбрасываем счётчики, чтобы при исключении в prepare_and_push
+        # не остался результат прошлой пачки
+        Extractor.cnt_part_load = 0
+        Extractor.cnt_successes = 0
+
         if not self.films_to_es:
             return None
 
@@ -267,9 +361,7 @@ class Extractor:
                 """
 
         # Считывание данных из PG и обогащеине
-        with self.conn.cursor() as cur:
-            cur = self.query_exec(cur, query)
-
+        with self.query_exec(query) as cur:
             while records := cur.fetchmany(self.fetch_size):
                 raw_records = [FilmworkModel(**record['films']) for record in records]
                 film_works_to_elastic = [self.make_names(record) for record in raw_records]
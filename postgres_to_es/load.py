@@ -1,16 +1,44 @@
 import logging
 import requests
 
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import streaming_bulk
-from backoff_dec import backoff
+from elasticsearch import Elasticsearch, ApiError
+from elasticsearch.helpers import streaming_bulk, BulkIndexError
+from elastic_transport import TransportError, SerializationError
+from backoff_dec import backoff, is_transient
 from models import FilmworkModel
 from http import HTTPStatus
 
 
+ES_RETRY_STATUSES = (HTTPStatus.TOO_MANY_REQUESTS,
+                     HTTPStatus.BAD_GATEWAY,
+                     HTTPStatus.SERVICE_UNAVAILABLE,
+                     HTTPStatus.GATEWAY_TIMEOUT)
+
+
+def is_es_transient(exc: BaseException) -> bool:
+    """Временные ошибки ElasticSearch: сетевые ошибки транспорта, таймауты
+    и ответы о перегрузке/недоступности, в том числе отказы bulk-вставки,
+    где все документы отклонены из-за перегрузки (es_rejected_execution_exception).
+    Остальные ответы API (неверный маппинг, ошибки в документах) считаются постоянными.
+    """
+    if isinstance(exc, ApiError):
+        return exc.meta.status in ES_RETRY_STATUSES
+    if isinstance(exc, BulkIndexError):
+        return bool(exc.errors) and all(item.get('status') in ES_RETRY_STATUSES
+                                        for error in exc.errors
+                                        for item in error.values())
+    if isinstance(exc, SerializationError):
+        # ошибка (де)сериализации на стороне клиента, повтор её не исправит
+        return False
+    if isinstance(exc, (TransportError, requests.ConnectionError, requests.Timeout)):
+        return True
+    return is_transient(exc)
+
+
 class Load:
     successes = 0
     docs_count = 0
+    request_timeout = 10  # сек, чтобы зависший ES не блокировал вызов бесконечно
 
     index_settings = {
         "refresh_interval": "1s",
@@ -74,20 +102,26 @@ class Load:
         self.es = self.connect_to_es()
         self.data = data
 
-    @backoff()
+    @backoff(backend='elasticsearch', transient=is_es_transient)
     def connect_to_es(self):
         return Elasticsearch(self.es_socket)
 
-    @backoff()
+    def reconnect(self, *args, **kwargs):
+        """Хук перед повторной попыткой: пересоздаёт клиент ElasticSearch."""
+        logging.info('Переподключение к ElasticSearch')
+        self.es.close()
+        self.es = self.connect_to_es()
+
+    @backoff(backend='elasticsearch', transient=is_es_transient)
     def create_index(self):
         self.es.indices.create(index='movies',
                                settings=Load.index_settings,
                                mappings=Load.index_mappings)
 
-    @backoff()
+    @backoff(backend='elasticsearch', transient=is_es_transient)
     def check_index(self):
         url = self.es_socket + 'movies/_mapping'
-        message = requests.get(url)
+        message = requests.get(url, timeout=Load.request_timeout)
         if message.status_code == HTTPStatus.NOT_FOUND:
             return False
         return True
@@ -100,7 +134,7 @@ class Load:
             doc['_source'] = record.model_dump_json()
             yield doc
 
-    @backoff()
+    @backoff(backend='elasticsearch', transient=is_es_transient, on_retry=reconnect)
     def insert_films(self, chunk_size: int) -> int:
         """
         Функция для вставки пачки записей о фильмах в ES
@@ -10,6 +10,7 @@ import logging
 
 from dotenv import load_dotenv, find_dotenv
 from contextlib import closing
+from functools import partial
 from psycopg2.extras import DictCursor
 from backoff_dec import backoff
 
@@ -28,13 +29,8 @@ load_dotenv(find_dotenv())
 # Перейти к следующей пачке данных, пока есть данные
 
 
-@backoff()
-def query_exec(cursor, query_to_exec):
-    cursor.execute(query_to_exec)
-    return cursor
-
-
-@backoff()
+# при старте ждём появления Postgres без ограничения числа попыток
+@backoff(max_attempts=0, deadline=0, backend='postgres', transient=extractor.is_pg_transient)
 def connect_to_db(params):
     return psycopg2.connect(**params, cursor_factory=DictCursor)
 
@@ -55,8 +51,10 @@ if __name__ == '__main__':
     es_dsl = {'host': es_host, 'port': es_port}
 
     try:
-        with closing(connect_to_db(pg_dsl)) as connection:
-            extract = extractor.Extractor(connection, es_dsl)
+        # закрываем и исходное соединение (если Extractor не создан), и текущее
+        # соединение Extractor, которое могло быть пересоздано при переподключении
+        with closing(connect_to_db(pg_dsl)) as connection, \
+                closing(extractor.Extractor(connection, es_dsl, partial(connect_to_db, pg_dsl))) as extract:
             extract.postgres_producer()
 
     except Exception as e: